@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import io
+import os
+import time
 from textfree86 import cli
 
 root = cli.Command('example', 'cli example programs')
@@ -10,7 +13,7 @@ def nop():
     pass
 
 add = root.subcommand('add', "adds two numbers")
-@add.run("a b")
+@add.run("a b", cacheable=True)
 def add_cmd(a, b):
     return a+b
 
@@ -31,7 +34,7 @@ demo = root.subcommand('demo', "demo of argspec")
     [opt1]           # optional 1
     [opt2]           # optional 2
     [tail...]         # tail arg
-''')
+''', choices={'value': ['red', 'green', 'blue'], 'opt1': ['fast', 'slow']})
 def run(switch, value, bucket, pos1, opt1, opt2, tail):
     """a demo command that shows all the types of options"""
     output = [ 
@@ -55,6 +58,60 @@ two = root.subcommand('write', 'write a file')
 def two_run(file):
     file.write(b"Test\n\n\n")
 
+tree = root.subcommand('tree', 'list the files in a directory')
+@tree.run("src:indir", exclude={'src': ['*.pyc', '.git/*']})
+def tree_run(src):
+    out = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            out.append(os.path.relpath(os.path.join(dirpath, filename), src))
+    return "\n".join(out)
+
+split = root.subcommand('split', 'write each line of a file to its own file')
+@split.run("file:infile dest:outdir")
+def split_run(file, dest):
+    for idx, line in enumerate(file.read().splitlines()):
+        with open(os.path.join(dest, "line{}.txt".format(idx)), "wb") as fh:
+            fh.write(line)
+
+tail = root.subcommand('tail', 'print the end of a file')
+@tail.run("--bytes:int file:lazyfile")
+def tail_run(file, bytes):
+    """only the end of the file is read, so only the end is sent"""
+    if bytes is None:
+        bytes = 1024
+    file.seek(0, io.SEEK_END)
+    file.seek(max(0, file.tell() - bytes))
+    return file.read().decode('utf-8', 'replace')
+
+upper = root.subcommand('upper', 'upper case a stream, a line at a time')
+@upper.run("input:stdin output:stdout")
+def upper_run(input, output):
+    """pass - for either to use stdin or stdout"""
+    for line in input:
+        output.write(line.upper())
+
+wait = root.subcommand('sleep', 'wait a while')
+@wait.run("seconds:int")
+def wait_run(seconds, _cancel):
+    """sleeps, stopping early if the call is cancelled"""
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        _cancel.check()
+        time.sleep(0.1)
+    return "slept for {} seconds".format(seconds)
+
+@root.resource('_started')
+def started():
+    """made once per process, so stays the same between calls to a server"""
+    return time.time()
+
+uptime = root.subcommand('uptime', 'how long this process has been serving')
+@uptime.run()
+def uptime_run(_started):
+    return "up {:.3f} seconds".format(time.time() - _started)
+
 root.main(__name__)
 
 
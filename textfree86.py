@@ -1,12 +1,36 @@
 #!/usr/bin/env python3
 
 import io
+import array
+import bisect
 import os
 import sys
+import time
 import types
+import shutil
+import fnmatch
+import tarfile
+import tempfile
+import hashlib
 import itertools
+import queue
+import threading
+import traceback
+import marshal
+import cProfile
+import pstats
 import subprocess
+import http.client
+import http.server
+import urllib.parse
+import concurrent.futures
 from enum import Enum
+from collections import OrderedDict, deque
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = resource_tracker = None
 
 
 ARGTYPES = Enum('ArgType', """
@@ -15,7 +39,9 @@ ARGTYPES = Enum('ArgType', """
     float num number
     str string
     scalar
-    infile outfile
+    infile outfile lazyfile
+    indir outdir
+    stdin stdout
 """)
 #   stretch goals: rwfile jsonfile textfile
 
@@ -300,6 +326,12 @@ def parse_args(argspec, argv, environ):
         raise wire.BadArg("unnamed options given {!r}".format(" ".join(options)))
     if options:
         raise wire.BadArg("unrecognised option: {!r}".format(" ".join(options)))
+
+    for name, values in args.items():
+        for value in (values if isinstance(values, list) else [values]):
+            if isinstance(value, wire.DirHandle):
+                value.include = argspec.include.get(name)
+                value.exclude = argspec.exclude.get(name)
     return args
 
 def try_parse(name, arg, argtype):
@@ -309,6 +341,16 @@ def try_parse(name, arg, argtype):
         return wire.FileHandle(arg, "read")
     elif argtype == "outfile":
         return wire.FileHandle(arg, "write")
+    elif argtype == "lazyfile":
+        return wire.FileHandle(arg, "lazy")
+    elif argtype == "indir":
+        return wire.DirHandle(arg, "read")
+    elif argtype == "outdir":
+        return wire.DirHandle(arg, "write")
+    elif argtype == "stdin":
+        return wire.StreamHandle(arg, "read")
+    elif argtype == "stdout":
+        return wire.StreamHandle(arg, "write")
 
     elif argtype in ("int","integer"):
         try:
@@ -360,6 +402,34 @@ class codec:
         list = "L" <number of entries as ascii string> \x7F (<encoded value>)* \7F
         record = "R" <number of pairs as ascii string> \x7F (<encoded key> <encoded value>)* \7F
         record = "T" <name as printable ascii string> \x7F <encoded value> \7F
+        array = "A" <typecode> <number of items as ascii string> \x7F <items> \x7F
+        packed list = "P" <typecode> <number of items as ascii string> \x7F <items> \x7F
+        string ref = "s" <index as ascii string> \x7F
+        tag ref = "t" <index as ascii string> \x7F <encoded value> \7F
+        shared bytes = "m" <number bytes as ascii string> \x7F <segment name as ascii string> \x7F
+        streamed bytes = "c" <number bytes as ascii string> \x7F
+
+        tagged objects are sent as a record of their attributes, skipping
+        any starting with '_'
+
+        arrays and packed lists hold 8 byte little-endian items, typecode "q"
+        for signed integers and "d" for doubles. array.array values become
+        arrays, and lists of at least PACK_MIN ints (or floats) become packed
+        lists, which decode back into lists without parsing each item
+
+        string and tag refs index a codec.Table, numbering tag names and
+        record keys for the life of a connection: dump() and parse() only
+        use them when given one. other strings are always sent inline, so
+        one-off values don't use up the table
+
+        shared bytes are only sent when the table has a codec.SharedBytes,
+        i.e. the peer is known to be on the same host, and only accepted
+        when the decoding table has one enabled, otherwise they are an error
+
+        streamed bytes are sent by cli.Channel, and over http, for bytes
+        over STREAM_MIN, when the table collects them in table.streamed:
+        the bytes follow the message, each as a message of their own, and
+        parse() returns an empty bytearray of the right size to fill
 
         note: 0..31 and 128..255 are not used as types for a reason
         
@@ -368,7 +438,6 @@ class codec:
             encode ints 0..31 as types \x00 .. \x1f
             types for pos int, neg int, float that use <width as codepoint> <bytes>
                 i.e "+\x01\x20 for 32, "-\x01\x7F" as -127
-            types to define numbers for tag/field names in records, 
 
     """
     tags = {}
@@ -383,9 +452,19 @@ class codec:
     LIST = ord("L")
     RECORD = ord("R")
     TAG = ord("T")
+    ARRAY = ord("A")
+    PACKED = ord("P")
+    STRING_REF = ord("s")
+    TAG_REF = ord("t")
+    SHARED = ord("m")
+    STREAMED = ord("c")
+    STREAM_MIN = 256 * 1024
+    INTERN_MAX = 64
     END = 127
+    PACK_MIN = 4
+    SWAP = sys.byteorder != "little"
 
-    def parse(buf, offset=0):
+    def parse(buf, offset=0, table=None):
         peek = buf[offset]
         if peek == codec.TRUE:
             return True, offset+1
@@ -408,6 +487,21 @@ class codec:
             obj = buf[start:end]
             end = buf.index(codec.END, end)
             return obj, end+1
+        elif peek == codec.SHARED:
+            if table is None or table.shared is None or not table.shared.enabled:
+                raise ValueError("shared bytes from a peer not known to be on this host")
+            end = buf.index(codec.END, offset+1)
+            size = int(buf[offset+1:end].decode('ascii'))
+            start, end = end+1, buf.index(codec.END, end+1)
+            name = buf[start:end].decode('ascii')
+            return codec.SharedBytes.take(name, size), end+1
+        elif peek == codec.STREAMED:
+            if table is None or table.streamed is None:
+                raise ValueError("streamed bytes outside of a channel")
+            end = buf.index(codec.END, offset+1)
+            obj = bytearray(int(buf[offset+1:end].decode('ascii')))
+            table.streamed.append(obj)
+            return obj, end+1
         elif peek == codec.STRING:
             end = buf.index(codec.END, offset+1)
             size = int(buf[offset+1:end].decode('ascii'))
@@ -421,7 +515,7 @@ class codec:
             start = end+1
             out = []
             for _ in range(size):
-                value, start = codec.parse(buf, start)
+                value, start = codec.parse(buf, start, table)
                 out.append(value)
             end = buf.index(codec.END, start)
             return out, end+1
@@ -431,26 +525,44 @@ class codec:
             start = end+1
             out = {}
             for _ in range(size):
-                key, start = codec.parse(buf, start)
-                value, start = codec.parse(buf, start)
+                key, start = codec.parse(buf, start, table)
+                value, start = codec.parse(buf, start, table)
                 out[key] = value
 
             end = buf.index(codec.END, start)
             return out, end+1
-        elif peek == codec.TAG:
+        elif peek == codec.STRING_REF:
+            end = buf.index(codec.END, offset+1)
+            return table.names[int(buf[offset+1:end])], end+1
+        elif peek == codec.TAG or peek == codec.TAG_REF:
             end = buf.index(codec.END, offset+1)
             tag = (buf[offset+1:end].decode('ascii'))
+            if peek == codec.TAG_REF:
+                tag = table.names[int(tag)]
             cls = codec.classes[tag]
-            args, start = codec.parse(buf, end+1)
+            args, start = codec.parse(buf, end+1, table)
             out = cls(**args)
             end = buf.index(codec.END, start)
             return out, end+1
+        elif peek == codec.ARRAY or peek == codec.PACKED:
+            end = buf.index(codec.END, offset+1)
+            typecode = chr(buf[offset+1])
+            size = int(buf[offset+2:end].decode('ascii'))
+            start, end = end+1, end+1+size*8
+            out = array.array(typecode)
+            out.frombytes(buf[start:end])
+            if codec.SWAP:
+                out.byteswap()
+            if peek == codec.PACKED:
+                out = out.tolist()
+            end = buf.index(codec.END, end)
+            return out, end+1
 
 
         raise Exception('bad buf {}'.format(peek.encode('ascii')))
 
 
-    def dump(obj, buf):
+    def dump(obj, buf, table=None, key=False):
         if obj is True:
             buf.append(codec.TRUE)
         elif obj is False:
@@ -462,48 +574,217 @@ class codec:
             buf.extend(str(obj).encode('ascii'))
             buf.append(codec.END)
         elif isinstance(obj, float):
-            buf.append(codec.INT)
+            buf.append(codec.FLOAT)
             buf.extend(float.hex(obj).encode('ascii'))
             buf.append(codec.END)
         elif isinstance(obj, (bytes,bytearray)):
+            if table is not None and table.shared is not None and table.shared.usable(len(obj)):
+                name = codec.SharedBytes.put(obj)
+                buf.append(codec.SHARED)
+                buf.extend(str(len(obj)).encode('ascii'))
+                buf.append(codec.END)
+                buf.extend(name.encode('ascii'))
+                buf.append(codec.END)
+                return buf
+            if table is not None and table.streamed is not None and len(obj) > codec.STREAM_MIN:
+                table.streamed.append(obj)
+                buf.append(codec.STREAMED)
+                buf.extend(str(len(obj)).encode('ascii'))
+                buf.append(codec.END)
+                return buf
             buf.append(codec.BYTES)
             buf.extend(str(len(obj)).encode('ascii'))
             buf.append(codec.END)
             buf.extend(obj)
             buf.append(codec.END)
         elif isinstance(obj, (str)):
+            idx = None
+            if key and table is not None and len(obj) <= codec.INTERN_MAX:
+                idx = table.intern(obj)
+            if idx is not None:
+                buf.append(codec.STRING_REF)
+                buf.extend(str(idx).encode('ascii'))
+                buf.append(codec.END)
+                return buf
             obj = obj.encode('utf-8')
             buf.append(codec.STRING)
             buf.extend(str(len(obj)).encode('ascii'))
             buf.append(codec.END)
             buf.extend(obj)
             buf.append(codec.END)
+        elif isinstance(obj, array.array):
+            if obj.typecode not in "qd":
+                try:
+                    obj = array.array("d" if obj.typecode in "fd" else "q", obj)
+                except (OverflowError, TypeError):
+                    # unsigned values past int64, or unicode arrays
+                    return codec.dump(obj.tolist(), buf, table)
+            codec.dump_array(codec.ARRAY, obj, buf)
         elif isinstance(obj, (list, tuple)):
+            packed = codec.packable(obj)
+            if packed is not None:
+                codec.dump_array(codec.PACKED, packed, buf)
+                return buf
             buf.append(codec.LIST)
             buf.extend(str(len(obj)).encode('ascii'))
             buf.append(codec.END)
             for x in obj:
-                codec.dump(x, buf)
+                codec.dump(x, buf, table)
             buf.append(codec.END)
         elif isinstance(obj, (dict)):
             buf.append(codec.RECORD)
             buf.extend(str(len(obj)).encode('ascii'))
             buf.append(codec.END)
             for k,v in obj.items():
-                codec.dump(k, buf)
-                codec.dump(v, buf)
+                codec.dump(k, buf, table, key=True)
+                codec.dump(v, buf, table)
             buf.append(codec.END)
         elif obj.__class__ in codec.tags:
-            tag = codec.tags[obj.__class__].encode('ascii')
-            buf.append(codec.TAG)
-            buf.extend(tag)
+            fields = {k: v for k, v in obj.__dict__.items() if not k.startswith('_')}
+            tag = codec.tags[obj.__class__]
+            idx = table.intern(tag) if table is not None else None
+            if idx is not None:
+                buf.append(codec.TAG_REF)
+                buf.extend(str(idx).encode('ascii'))
+            else:
+                buf.append(codec.TAG)
+                buf.extend(tag.encode('ascii'))
             buf.append(codec.END)
-            codec.dump(obj.__dict__, buf)
+            codec.dump(fields, buf, table)
             buf.append(codec.END)
         else:
             raise Exception('bad obj {!r}'.format(obj))
         return buf
 
+    class Table:
+        """
+            strings numbered by the order they were first sent
+
+            a sender interns tag names and short record keys, and
+            sends the newly numbered names ahead of the message using them.
+            a receiver defines names in the order they arrive
+        """
+        LIMIT = 4096
+
+        def __init__(self):
+            self.ids = {}
+            self.names = []
+            self.pending = []
+            self.lock = threading.Lock()
+            self.shared = None
+            self.streamed = None
+
+        def message(self):
+            """a table sharing these names, collecting the streamed bytes of one message"""
+            table = codec.Table.__new__(codec.Table)
+            table.__dict__.update(self.__dict__)
+            table.streamed = []
+            return table
+
+        def intern(self, name):
+            idx = self.ids.get(name)
+            if idx is None:
+                if len(self.names) >= codec.Table.LIMIT:
+                    return None
+                idx = self.ids[name] = len(self.names)
+                self.names.append(name)
+                self.pending.append(name)
+            return idx
+
+        def flush(self):
+            pending, self.pending = self.pending, []
+            return pending
+
+        def define(self, names):
+            self.names.extend(names)
+
+    class SharedBytes:
+        """
+            moves large bytes through shared memory instead of the pipe
+
+            the sender copies the bytes into a new segment and sends its name,
+            the receiver copies them out and unlinks it. the sender only does
+            so once the peer has answered a probe (see cli.Channel), and waits
+            up to WAIT seconds for that answer before falling back to inline
+            bytes. a message that is never parsed leaks its segments
+        """
+        MIN = 256 * 1024
+        WAIT = 1.0
+
+        def __init__(self, enabled=None):
+            self.enabled = enabled
+            self.answered = threading.Event()
+            if enabled is not None:
+                self.answered.set()
+
+        def answer(self, enabled):
+            self.enabled = enabled
+            self.answered.set()
+
+        def usable(self, size):
+            if size < codec.SharedBytes.MIN:
+                return False
+            self.answered.wait(codec.SharedBytes.WAIT)
+            return bool(self.enabled)
+
+        def put(buf):
+            segment = shared_memory.SharedMemory(create=True, size=max(1, len(buf)))
+            segment.buf[:len(buf)] = buf
+            # the receiver unlinks it, not us
+            resource_tracker.unregister(segment._name, "shared_memory")
+            segment.close()
+            return segment.name
+
+        def take(name, size):
+            segment = shared_memory.SharedMemory(name=name)
+            try:
+                return bytes(segment.buf[:size])
+            finally:
+                segment.close()
+                segment.unlink()
+
+        def probe():
+            """a segment holding a random nonce, and the frame naming it"""
+            nonce = os.urandom(16)
+            segment = shared_memory.SharedMemory(create=True, size=len(nonce))
+            segment.buf[:len(nonce)] = nonce
+            return segment, segment.name.encode('ascii') + b" " + nonce.hex().encode('ascii')
+
+        def check_probe(payload):
+            name, nonce = payload.decode('ascii').split(" ")
+            try:
+                segment = shared_memory.SharedMemory(name=name)
+            except (OSError, ValueError):
+                return False
+            try:
+                return bytes(segment.buf[:16]) == bytes.fromhex(nonce)
+            finally:
+                resource_tracker.unregister(segment._name, "shared_memory")
+                segment.close()
+
+    def packable(obj):
+        if len(obj) < codec.PACK_MIN:
+            return None
+        kinds = set(map(type, obj))
+        if kinds == {int}:
+            try:
+                return array.array("q", obj)
+            except OverflowError:
+                return None
+        elif kinds == {float}:
+            return array.array("d", obj)
+
+    def dump_array(kind, obj, buf):
+        if codec.SWAP:
+            obj = array.array(obj.typecode, obj)
+            obj.byteswap()
+        buf.append(kind)
+        buf.append(ord(obj.typecode))
+        buf.extend(str(len(obj)).encode('ascii'))
+        buf.append(codec.END)
+        buf.extend(obj.tobytes())
+        buf.append(codec.END)
+
     def register():
         def decorator(cls):
             name = cls.__name__
@@ -520,14 +801,54 @@ class wire:
 
     @codec.register()
     class FileHandle:
-        def __init__(self, name, mode, buf=None):
+        def __init__(self, name, mode, buf=None, size=None):
             self.name = name
             self.mode = mode
             self.buf = buf
+            self.size = size
+
+    @codec.register()
+    class Fetch:
+        """sent by the server during a call, for a range of a lazy file"""
+        def __init__(self, name, offset, size):
+            self.name = name
+            self.offset = offset
+            self.size = size
+
+    @codec.register()
+    class StreamHandle:
+        """
+            a file, or stdin/stdout if the name is "-", sent a chunk at a
+            time while the call runs. id tells the chunks of each apart
+        """
+        def __init__(self, name, mode, id=None):
+            self.name = name
+            self.mode = mode
+            self.id = id
+
+    @codec.register()
+    class Chunk:
+        """the next piece of a stream, or the end of it if data is empty"""
+        def __init__(self, id, data):
+            self.id = id
+            self.data = data
+
+    @codec.register()
+    class DirHandle:
+        """
+            a directory, sent as a tar stream after the request (indir), or
+            after the response (outdir). path is where it is on this machine
+        """
+        def __init__(self, name, mode, include=None, exclude=None, path=None):
+            self.name = name
+            self.mode = mode
+            self.include = include
+            self.exclude = exclude
+            self.path = path
 
     @codec.register()
     class Argspec:
-        def __init__(self, switches, flags, lists, positional, optional, tail, argtypes, descriptions):
+        def __init__(self, switches, flags, lists, positional, optional, tail, argtypes, descriptions, choices=None, include=None, exclude=None):
             self.switches = switches
             self.flags = flags
             self.lists = lists
@@ -536,41 +857,98 @@ class wire:
             self.tail = tail
             self.argtypes = argtypes
             self.descriptions = descriptions
+            self.choices = choices or {}
+            self.include = include or {}
+            self.exclude = exclude or {}
 
     @codec.register()
     class Request:
-        def __init__(self, action, path, argv):
+        def __init__(self, action, path, argv, timeout=None, digest=None, profile=False):
             self.action = action
             self.path = path
             self.argv = argv
+            self.timeout = timeout
+            self.digest = digest
+            self.profile = profile
 
     @codec.register()
     class Response:
-        def __init__(self, exit_code, value, file_handles=()):
+        def __init__(self, exit_code, value, file_handles=(), profile=None):
             self.exit_code = exit_code
             self.value = value
             self.file_handles = file_handles
+            self.profile = profile
+
+    @codec.register()
+    class Stale:
+        """the reply to a call made against an out of date command tree"""
+        def __init__(self, command):
+            self.command = command
             
+    @codec.register()
+    class Index:
+        """
+            sorted keys and their completions, for prefix lookups. values
+            is None when each key completes to itself
+        """
+        def __init__(self, keys, values=None):
+            self.keys = keys
+            self.values = values
+
+        def lookup(self, prefix):
+            out = []
+            for idx in range(bisect.bisect_left(self.keys, prefix), len(self.keys)):
+                if not self.keys[idx].startswith(prefix):
+                    break
+                out.append(self.values[idx] if self.values is not None else self.keys[idx])
+            return out
+
+    def build_index(entries):
+        entries = sorted(entries)
+        return wire.Index([key for key, _ in entries], [value for _, value in entries])
+
     @codec.register()
     class Command:
-        def __init__(self, prefix, name, subcommands, short, long, argspec):
+        def __init__(self, prefix, name, subcommands, short, long, argspec, index=None):
             self.prefix = prefix
             self.name = name
             self.subcommands = subcommands
             self.short, self.long = short, long
             self.argspec = argspec
+            self.index = index
+
+        def build_index(self):
+            """
+                built when the tree is rendered, and sent and cached along
+                with it, so completion only has to look up a prefix
+            """
+            flags, choices = [], {}
+            if self.argspec:
+                flags.extend((x, "--{}".format(x)) for x in self.argspec.switches)
+                flags.extend((x, "--{}=".format(x)) for x in self.argspec.flags)
+                flags.extend((x, "--{}=".format(x)) for x in self.argspec.lists)
+                for name, values in self.argspec.choices.items():
+                    choices[name] = wire.Index(sorted(values))
+            self.index = {
+                'subcommands': wire.Index(sorted(self.subcommands)),
+                'flags': wire.build_index(flags),
+                'choices': choices,
+            }
 
         def version(self):
             return "<None>"
 
+        def digest(self):
+            """a hash of the encoded tree, to tell if a cached copy is current"""
+            if getattr(self, '_digest', None) is None:
+                self._digest = hashlib.sha256(codec.dump(self, bytearray())).hexdigest()
+            return self._digest
+
         def complete(self, path, text):
             if path and path[0] in self.subcommands:
                 return self.subcommands[path[0]].complete(path[1:], text)
-            elif not path:
-                output = []
-                for name in self.subcommands:
-                    if name.startswith(text):
-                        output.append(name)
+            if not path:
+                output = self.index['subcommands'].lookup(text)
                 if output:
                     return output
 
@@ -579,22 +957,30 @@ class wire:
             elif text.startswith('-'):
                 return self.complete_flag(text[1:])
             else:
-                # work out which positional, optional, or tail arg it is
-                # suggest type
-                return ()
+                return self.complete_value(path, text)
 
         def complete_flag(self, prefix):
             if '=' in prefix:
-                # check to see if it's a completeable type
-                return ()
+                name, value = prefix.split('=', 1)
+                return ["--{}={}".format(name, v) for v in self.complete_choice(name, value)]
             else:
-                out = []
-                out.extend("--{}".format(x) for x in self.argspec.switches if x.startswith(prefix))
-                out.extend("--{}=".format(x) for x in self.argspec.flags if x.startswith(prefix))
-                out.extend("--{}=".format(x) for x in self.argspec.lists if x.startswith(prefix))
-                return out
-                
-            
+                return self.index['flags'].lookup(prefix)
+
+        def complete_value(self, path, text):
+            # work out which positional, optional, or tail arg it is
+            if not self.argspec:
+                return ()
+            names = list(self.argspec.positional) + list(self.argspec.optional)
+            count = len([arg for arg in path if arg and not arg.startswith('-')])
+            if count < len(names):
+                return self.complete_choice(names[count], text)
+            elif self.argspec.tail:
+                return self.complete_choice(self.argspec.tail, text)
+            return ()
+
+        def complete_choice(self, name, prefix):
+            index = self.index['choices'].get(name)
+            return index.lookup(prefix) if index else ()
 
         def parse_args(self, path,argv, environ):
             if argv and argv[0] in self.subcommands:
@@ -694,26 +1080,117 @@ class cli:
             self.errors = errors
 
     class FakeRemoteCommand:
-        def __init__(self, root):
+        """
+            runs a command in-process, passing objects straight through
+
+            with check=True (or TEXTFREE86_CHECK set in the environment),
+            the tree, arguments and results are round-tripped through the
+            codec, to catch anything that wouldn't survive a real pipe
+        """
+        fresh = True
+
+        def __init__(self, root, check=False):
             self.root = root
+            self.check = check
 
-        def render(self):
-            buf = codec.dump(self.root.render(), bytearray())
+        def roundtrip(self, obj):
+            buf = codec.dump(obj, bytearray())
             obj, _ = codec.parse(buf, 0)
             return obj
 
-        def call(self, path, argv):
-            path = codec.dump(path, bytearray())
-            argv = codec.dump(argv, bytearray())
-            path, _ = codec.parse(path, 0)
-            argv, _ = codec.parse(argv, 0)
-
-            result = self.root.call(path, argv)
-            buf = codec.dump(result, bytearray())
-            result, _ = codec.parse(buf,0)
+        def render(self):
+            if self.check:
+                return self.roundtrip(self.root.render())
+            return self.root.render()
 
+        def call(self, path, argv):
+            if self.check:
+                path = self.roundtrip(path)
+                argv = self.roundtrip(argv)
+
+            copies = []
+            for handle in cli.dir_handles(argv):
+                if handle.include or handle.exclude:
+                    # filtered like in pipe mode: indirs copied in, outdirs copied back
+                    handle.path = tempfile.mkdtemp(prefix="textfree86-")
+                    copies.append(handle.path)
+                    if handle.mode == "read":
+                        cli.copy_dir(handle.name, handle.path, handle.include, handle.exclude)
+                else:
+                    handle.path = handle.name
+            try:
+                result = self.root.call(path, argv)
+                if isinstance(result, wire.Response) and result.exit_code == 0:
+                    for handle in cli.dir_handles(argv):
+                        if handle.mode == "write" and handle.path != handle.name:
+                            cli.copy_dir(handle.path, handle.name, handle.include, handle.exclude)
+            finally:
+                for copy in copies:
+                    shutil.rmtree(copy, ignore_errors=True)
+
+            if self.check:
+                result = self.roundtrip(result)
             return result
 
+    class ResultCache:
+        """
+            memoizes wire.Response values for a cacheable command
+            keys are the parsed argv, with infile contents replaced by a hash
+            least recently used entries are evicted once maxsize is reached,
+            and entries older than ttl seconds (if given) are discarded
+        """
+        def __init__(self, maxsize=128, ttl=None):
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self.entries = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+        def key(self, argv):
+            """None if the call can't be cached, i.e. it takes directories, lazy files, or streams"""
+            if cli.pipe_handles(argv):
+                return None
+            def freeze(value):
+                if isinstance(value, list):
+                    return tuple(freeze(v) for v in value)
+                elif isinstance(value, wire.FileHandle):
+                    if value.mode == "read":
+                        return ("infile", hashlib.sha256(value.buf).hexdigest())
+                    return ("outfile",)
+                return (type(value).__name__, value)
+            return tuple((name, freeze(value)) for name, value in sorted(argv.items()))
+
+        def get(self, key):
+            entry = self.entries.get(key)
+            if entry is not None:
+                created, response = entry
+                if self.ttl is None or time.monotonic() - created < self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+        def put(self, key, response):
+            self.entries[key] = (time.monotonic(), response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        def clear(self):
+            self.entries.clear()
+
+        def stats(self):
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
     class Command:
         def __init__(self, name, short=None, long=None):
             self.name = name
@@ -724,6 +1201,9 @@ class cli:
             self.long = None
             self.argspec = None
             self.nargs = 0
+            self.cache = None
+            self.context_args = []
+            self.context = cli.Context()
 
         # -- builder methods
 
@@ -731,19 +1211,48 @@ class cli:
             cmd = cli.Command(name, short)
             cmd.prefix.extend(self.prefix)
             cmd.prefix.append(self.name)
+            cmd.context = self.context
             self.subcommands[name] = cmd
             return cmd
 
-        def run(self, argspec=None):
-            """A decorator for setting the function to be run"""
+        def resource(self, name):
+            """A decorator for a function that sets up a resource
+
+            commands that take an argument called name are passed the
+            resource, which is made on first use and kept for the life of
+            the process. if the function is a generator, the value it yields
+            is the resource, and it is resumed at exit to tear it down
+            """
+            def decorator(fn):
+                self.context.add(name, fn)
+                return fn
+            return decorator
+
+        def run(self, argspec=None, *, choices=None, include=None, exclude=None, cacheable=False, maxsize=128, ttl=None):
+            """A decorator for setting the function to be run
+
+            choices maps argument names to a list of values offered by
+            tab completion
+
+            include and exclude map indir/outdir argument names to lists of
+            globs, matched against paths relative to the directory
+
+            cacheable=True declares the function to be a pure function of its
+            arguments and input files, and repeated calls are answered from a
+            cli.ResultCache (of maxsize entries, each kept for ttl seconds)
+            """
 
             if argspec is not None:
                 self.nargs, self.argspec = parse_argspec(argspec)
 
+            if cacheable:
+                self.cache = cli.ResultCache(maxsize=maxsize, ttl=ttl)
+
             def decorator(fn):
                 self.run_fn = fn
 
                 args = list(self.run_fn.__code__.co_varnames[:self.run_fn.__code__.co_argcount])
+                self.context_args = [a for a in args if a.startswith('_')]
                 args = [a for a in args if not a.startswith('_')]
                 
                 if not self.argspec:
@@ -752,6 +1261,18 @@ class cli:
                     if self.nargs != len(args):
                         raise Exception('bad option definition')
 
+                if choices:
+                    for name, values in choices.items():
+                        if name not in args:
+                            raise Exception('choices given for unknown option {}'.format(name))
+                        self.argspec.choices[name] = [str(v) for v in values]
+
+                for globs, out in ((include, self.argspec.include), (exclude, self.argspec.exclude)):
+                    for name, values in (globs or {}).items():
+                        if self.argspec.argtypes.get(name) not in ("indir", "outdir"):
+                            raise Exception('globs given for non-directory option {}'.format(name))
+                        out[name] = list(values)
+
                 return fn
             return decorator
 
@@ -759,7 +1280,7 @@ class cli:
 
         def render(self):
             long =self.run_fn.__doc__ if (not self.long and self.run_fn) else self.long
-            return wire.Command(
+            command = wire.Command(
                 name = self.name,
                 prefix = self.prefix,
                 subcommands = {k: v.render() for k,v in self.subcommands.items()},
@@ -767,27 +1288,43 @@ class cli:
                 long = long,
                 argspec = self.argspec, 
             )
+            command.build_index()
+            return command
                 
 
 
-        def call(self, path, argv):
+        def call(self, path, argv, cancel=None):
             if path and path[0] == 'help':
                 return self.help(path[1:])
             elif path and path[0] in self.subcommands:
-                return self.subcommands[path[0]].call(path[1:], argv)
+                return self.subcommands[path[0]].call(path[1:], argv, cancel)
             elif self.run_fn:
-                if len(argv) == self.nargs:
-                    return self.invoke(argv)
-                else:
+                if len(argv) != self.nargs:
                     return wire.Response(-1, "bad options")
+                if self.cache is None:
+                    return self.invoke(argv, cancel)
+                key = self.cache.key(argv)
+                if key is None:
+                    return self.invoke(argv, cancel)
+                response = self.cache.get(key)
+                if response is None:
+                    response = self.invoke(argv, cancel)
+                    self.cache.put(key, response)
+                return response
             else:
                 if len(argv) == 0:
                     return wire.Response(0, self.render().manual())
                 else:
                     return wire.Response(-1, self.render.usage())
 
-        def invoke(self, argv):
+        def invoke(self, argv, cancel=None):
             args = {}
+            streams = []
+            for name in self.context_args:
+                if name == '_cancel':
+                    args[name] = cancel or cli.CancelToken()
+                else:
+                    args[name] = self.context.get(name)
             file_handles = {}
             for name, values in argv.items():
                 if isinstance(values, list):
@@ -804,6 +1341,13 @@ class cli:
                                 out.append(buf)
                                 if name not in file_handles: file_handles[name] = []
                                 file_handles[name].append(buf)
+                            elif value.mode == "lazy":
+                                out.append(cli.open_lazy(value))
+                        elif isinstance(value, wire.StreamHandle):
+                            streams.append(cli.open_stream(value))
+                            out.append(streams[-1])
+                        elif isinstance(value, wire.DirHandle):
+                            out.append(value.path)
                         else:
                             out.append(value)
                     args[name] = out
@@ -820,13 +1364,24 @@ class cli:
                             buf = io.BytesIO()
                             args[name] = buf
                             file_handles[name] = [buf]
+                        elif value.mode == "lazy":
+                            args[name] = cli.open_lazy(value)
+                    elif isinstance(values, wire.StreamHandle):
+                        streams.append(cli.open_stream(value))
+                        args[name] = streams[-1]
+                    elif isinstance(values, wire.DirHandle):
+                        args[name] = value.path
                     else:
                         args[name] = value
 
-            result = self.run_fn(**args)
+            try:
+                result = self.run_fn(**args)
 
-            if isinstance(result, types.GeneratorType):
-                result = list(result)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+            finally:
+                for fh in streams:
+                    fh.close()
 
             output_fhs = {}
             for name, fhs in file_handles.items():
@@ -845,85 +1400,1517 @@ class cli:
 
     #end Command
 
+    class Context:
+        """
+            the resources shared by a tree of commands, set up on first use,
+            and torn down in reverse order when the process is done with them
+
+            calls can run at the same time, so a resource is shared between
+            threads, and should be safe to use from them, like a pool
+        """
+        def __init__(self):
+            self.factories = {}
+            self.values = {}
+            self.teardown = []
+            self.lock = threading.Lock()
+
+        def add(self, name, fn):
+            if not name.startswith('_') or name == '_cancel':
+                raise Exception('bad resource name {}'.format(name))
+            self.factories[name] = fn
+
+        def get(self, name):
+            with self.lock:
+                if name in self.values:
+                    return self.values[name]
+                if name not in self.factories:
+                    raise Exception('no resource for argument {}'.format(name))
+                value = self.factories[name]()
+                if isinstance(value, types.GeneratorType):
+                    gen, value = value, next(value)
+                    self.teardown.append(gen)
+                self.values[name] = value
+                return value
+
+        def close(self):
+            with self.lock:
+                while self.teardown:
+                    gen = self.teardown.pop()
+                    try:
+                        next(gen)
+                    except StopIteration:
+                        pass
+                    except Exception:
+                        traceback.print_exc()
+                    else:
+                        gen.close()
+                self.values = {}
+
     def main(root):
         argv = sys.argv[1:]
         environ = os.environ
-        if argv == ["--pipe"]:
-            sys.exit(cli.offer_pipe(root))
-        else:
-            root = cli.FakeRemoteCommand(root)
-            sys.exit(cli.run(root, argv, environ))
+        try:
+            if argv[:1] == ["--pipe"] or argv[:1] and argv[0].startswith("--http="):
+                options = {}
+                for arg in argv[1:]:
+                    key, eq, value = arg[2:].partition('=')
+                    if not arg.startswith('--') or not eq or key not in cli.SERVE_OPTIONS:
+                        print("error: unknown option {}".format(arg), file=sys.stderr)
+                        sys.exit(-1)
+                    options[key] = value
+                recorder = cli.Recorder(options['record']) if 'record' in options else None
+                scheduler = cli.Scheduler(
+                    int(options.get('max-calls', cli.Scheduler.CALLS)),
+                    int(options.get('max-queue', cli.Scheduler.QUEUE)),
+                )
+                if argv[0] == "--pipe":
+                    ret = cli.offer_pipe(root, recorder, scheduler)
+                else:
+                    ret = cli.offer_http(root, argv[0].split('=', 1)[1], recorder, scheduler)
+            else:
+                client = cli.FakeRemoteCommand(root, check=bool(environ.get('TEXTFREE86_CHECK')))
+                ret = cli.run(client, argv, environ)
+        finally:
+            root.context.close()
+        sys.exit(ret)
+
+    SERVE_OPTIONS = ('record', 'max-calls', 'max-queue')
+
+    PIPE_OPTIONS = ('timeout', 'record', 'replay', 'concurrency', 'rate', 'profile')
 
     def open_pipe(args):
+        options = {}
+        while args and args[0].startswith('--') and args[0] != '--':
+            key, eq, value = args.pop(0)[2:].partition('=')
+            if key not in cli.PIPE_OPTIONS or (not eq and key != 'profile'):
+                print("error: unknown option --{}".format(key), file=sys.stderr)
+                return -1
+            options[key] = value
+        timeout = float(options['timeout']) if 'timeout' in options else None
+        recorder = cli.Recorder(options['record']) if 'record' in options else None
+
         if '--' in args:
             split = args.index('--')
             cmd, args = " ".join(args[:split]), args[split+1:]
+        elif 'replay' in options:
+            cmd, args = " ".join(args), []
         else:
             cmd, args = args[0], args[1:]
 
-        p = subprocess.Popen(
-            cmd,
-            shell = True,
-            stdin = subprocess.PIPE,
-            stdout = subprocess.PIPE,
-        )
-        root = cli.PipeClient(p.stdin, p.stdout)
-        ret = cli.run(root, args, os.environ)
-        p.stdin.close()
-        p.wait()
+        if 'replay' in options:
+            concurrency = int(options.get('concurrency', 1))
+            rate = float(options['rate']) if 'rate' in options else None
+            return cli.replay(cmd, options['replay'], concurrency, rate)
+
+        if cmd.startswith(("http://", "https://")):
+            root = cli.HTTPClient(cmd, timeout=timeout, cache=cli.cache_path(cmd), recorder=recorder, profile=options.get('profile'))
+            try:
+                return cli.run(root, args, os.environ)
+            except KeyboardInterrupt:
+                return 130
+            finally:
+                root.close()
+
+        root = cli.PipeClient(cmd=cmd, timeout=timeout, cache=cli.cache_path(cmd), recorder=recorder, profile=options.get('profile'))
+        try:
+            ret = cli.run(root, args, os.environ)
+        except KeyboardInterrupt:
+            ret = 130
+        except BrokenPipeError:
+            # our stdout was closed, like `| head`, and the call was cancelled
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            ret = 141
+        root.close()
         return ret
 
 
-    def offer_pipe(root):
+    class Channel:
+        """
+            multiplexes messages over a pair of pipes, in bounded chunks
+
+            each frame is "<stream> <kind> <size>\n", and a kind of:
+                data    <size> bytes of a message follow
+                end     <size> bytes follow, the last of the message
+                credit  no bytes follow, the peer may send <size> more
+                reset   no bytes follow, the peer has abandoned the stream
+                names   <size> bytes follow, a list of strings for the
+                        codec.Table, sent ahead of messages using them
+                probe   <size> bytes follow, naming a shared memory segment
+                        and the nonce inside it
+                probed  no bytes follow, <size> is 1 if the probe was read
+
+            a client with shared=True probes the server when it starts, and
+            if the server can read the segment, it is on the same host, and
+            both sides send large bytes through shared memory
+
+            a sender has WINDOW bytes of credit per stream, and waits for more
+            once it runs out. credit is returned as each chunk is consumed, so
+            at most WINDOW bytes of a stream are ever buffered in transit.
+            senders on different threads interleave chunk by chunk.
+
+            bytes over codec.STREAM_MIN in a message are sent after it, straight
+            from the object, and read straight into the decoded bytearray,
+            so neither end holds a second, encoded copy of them
+
+            clients open streams, servers accept them
+        """
+        WINDOW = 256 * 1024
+        CHUNK = 64 * 1024
+
+        class Stream:
+            def __init__(self, credit):
+                self.credit = credit
+                self.chunks = deque()
+                self.closed = False
+
+        def __init__(self, incoming, outgoing, server=False, window=None, chunk=None, shared=False):
+            self.incoming = incoming
+            self.outgoing = outgoing
+            self.server = server
+            self.window = window or cli.Channel.WINDOW
+            self.chunk = chunk or cli.Channel.CHUNK
+            self.lock = threading.Condition()
+            self.write_lock = threading.Lock()
+            self.streams = {}
+            self.accepted = deque()
+            self.last_accepted = 0
+            self.next_stream = 1
+            self.closed = False
+            self.encoder = codec.Table()
+            self.decoder = codec.Table()
+            self.probe = None
+            self.reader_thread = threading.Thread(target=self.read_frames, daemon=True)
+            self.reader_thread.start()
+            if shared and shared_memory is not None:
+                self.encoder.shared = codec.SharedBytes()
+                self.probe, payload = codec.SharedBytes.probe()
+                self.write_frame(0, b"probe", len(payload), payload)
+
+        def read_frames(self):
+            try:
+                while True:
+                    line = self.incoming.readline()
+                    if not line: break
+                    stream, kind, size = line.split()
+                    stream, size = int(stream), int(size)
+                    if kind == b"probed":
+                        self.encoder.shared.answer(size == 1)
+                        if size == 1:
+                            self.decoder.shared = codec.SharedBytes(True)
+                        self.probe.close()
+                        self.probe.unlink()
+                        continue
+                    if kind == b"credit" or kind == b"reset":
+                        with self.lock:
+                            state = self.streams.get(stream)
+                            if state is not None:
+                                if kind == b"reset":
+                                    state.closed = True
+                                state.credit += size
+                                self.lock.notify_all()
+                        continue
+                    payload = self.incoming.read(size)
+                    if len(payload) != size: break
+                    if kind == b"names":
+                        names, _ = codec.parse(payload, 0)
+                        self.decoder.define(names)
+                        continue
+                    if kind == b"probe":
+                        found = shared_memory is not None and codec.SharedBytes.check_probe(payload)
+                        if found:
+                            self.encoder.shared = codec.SharedBytes(True)
+                            self.decoder.shared = codec.SharedBytes(True)
+                        self.write_frame(0, b"probed", int(found))
+                        continue
+                    with self.lock:
+                        state = self.streams.get(stream)
+                        if state is None:
+                            # ignore the rest of a stream we've already closed
+                            if not self.server or stream <= self.last_accepted: continue
+                            state = self.streams[stream] = cli.Channel.Stream(self.window)
+                            self.accepted.append(stream)
+                            self.last_accepted = stream
+                        state.chunks.append((payload, kind == b"end"))
+                        self.lock.notify_all()
+            finally:
+                if self.encoder.shared is not None:
+                    self.encoder.shared.answer(self.encoder.shared.enabled)
+                with self.lock:
+                    self.closed = True
+                    self.lock.notify_all()
+
+        def write_frame(self, stream, kind, size, payload=None):
+            with self.write_lock:
+                self.outgoing.write(b"%d %s %d\n" % (stream, kind, size))
+                if payload:
+                    self.outgoing.write(payload)
+                self.outgoing.flush()
+
+        def open(self):
+            with self.lock:
+                stream = self.next_stream
+                self.next_stream += 1
+                self.streams[stream] = cli.Channel.Stream(self.window)
+                return stream
+
+        def close(self, stream):
+            with self.lock:
+                state = self.streams.pop(stream, None)
+                if state is not None:
+                    state.closed = True
+                    self.lock.notify_all()
+
+        def is_closed(self, stream):
+            with self.lock:
+                state = self.streams.get(stream)
+                return self.closed or state is None or state.closed
+
+        def reset(self, stream):
+            self.close(stream)
+            self.write_frame(stream, b"reset", 0)
+
+        def accept(self):
+            with self.lock:
+                while not self.accepted and not self.closed:
+                    self.lock.wait()
+                if self.accepted:
+                    return self.accepted.popleft()
+
+        def send(self, stream, buf):
+            self.send_chunk(stream, buf, end=True)
+
+        def send_chunk(self, stream, buf, end=False):
+            view = memoryview(buf)
+            offset = 0
+            if not view and not end:
+                return
+            while True:
+                with self.lock:
+                    state = self.streams[stream]
+                    while state.credit <= 0 and offset < len(view) and not (self.closed or state.closed):
+                        self.lock.wait()
+                    if self.closed or state.closed:
+                        raise BrokenPipeError("channel closed")
+                    size = min(self.chunk, state.credit, len(view) - offset)
+                    state.credit -= size
+                last = offset + size
+                if last == len(view):
+                    self.write_frame(stream, b"end" if end else b"data", size, view[offset:last])
+                    return
+                self.write_frame(stream, b"data", size, view[offset:last])
+                offset = last
+
+        def recv_chunks(self, stream, timeout=None):
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            with self.lock:
+                state = self.streams.get(stream)
+                if state is None:
+                    raise EOFError("stream closed")
+            while True:
+                with self.lock:
+                    while not state.chunks and not (self.closed or state.closed):
+                        if deadline is None:
+                            self.lock.wait()
+                            continue
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError("no reply from stream {}".format(stream))
+                        self.lock.wait(remaining)
+                    if not state.chunks:
+                        raise EOFError("stream closed" if state.closed else "channel closed")
+                    chunk, end = state.chunks.popleft()
+                if chunk:
+                    self.write_frame(stream, b"credit", len(chunk))
+                yield chunk
+                if end:
+                    return
+
+        def recv(self, stream, timeout=None):
+            return b"".join(self.recv_chunks(stream, timeout))
+
+        def writer(self, stream):
+            """a file object, sending one message as it is written"""
+            return io.BufferedWriter(cli.ChannelWriter(self, stream), self.chunk)
+
+        def reader(self, stream):
+            """a file object, reading one message as it arrives"""
+            return io.BufferedReader(cli.ChannelReader(self.recv_chunks(stream)), self.chunk)
+
+        def send_obj(self, stream, obj):
+            with self.encoder.lock:
+                self.encoder.streamed = []
+                try:
+                    buf = codec.dump(obj, bytearray(), self.encoder)
+                    streamed = self.encoder.streamed
+                finally:
+                    self.encoder.streamed = None
+                names = self.encoder.flush()
+                if names:
+                    payload = codec.dump(names, bytearray())
+                    self.write_frame(0, b"names", len(payload), payload)
+            self.send(stream, buf)
+            for data in streamed:
+                self.send(stream, data)
+
+        def recv_obj(self, stream, timeout=None):
+            table = self.decoder.message()
+            obj, _ = codec.parse(self.recv(stream, timeout), 0, table)
+            for out in table.streamed:
+                offset = 0
+                for chunk in self.recv_chunks(stream, timeout):
+                    if offset + len(chunk) > len(out):
+                        raise ValueError("streamed bytes longer than promised")
+                    out[offset:offset+len(chunk)] = chunk
+                    offset += len(chunk)
+                if offset != len(out):
+                    raise ValueError("streamed bytes shorter than promised")
+            return obj
+
+    class Cancelled(Exception):
+        pass
+
+    class CancelToken:
+        """
+            passed to a command as its _cancel argument, if it takes one
+
+            a token is cancelled once the request's deadline passes, or the
+            client asks. long running commands should poll cancelled(), or
+            call check() to raise cli.Cancelled
+        """
+        def __init__(self, timeout=None):
+            self.deadline = time.monotonic() + timeout if timeout is not None else None
+            self.reason = None
+            self.event = threading.Event()
+
+        def cancel(self, reason):
+            if self.reason is None:
+                self.reason = reason
+            self.event.set()
+
+        def cancelled(self):
+            if not self.event.is_set() and self.deadline is not None:
+                if time.monotonic() >= self.deadline:
+                    self.cancel("deadline exceeded")
+            return self.event.is_set()
+
+        def remaining(self):
+            if self.deadline is not None:
+                return max(0.0, self.deadline - time.monotonic())
+
+        def check(self):
+            if self.cancelled():
+                raise cli.Cancelled(self.reason)
+
+    class ChannelWriter(io.RawIOBase):
+        def __init__(self, channel, stream):
+            self.channel = channel
+            self.stream = stream
+
+        def writable(self):
+            return True
+
+        def write(self, buf):
+            self.channel.send_chunk(self.stream, buf)
+            return len(buf)
+
+        def close(self):
+            if not self.closed:
+                self.channel.send_chunk(self.stream, b"", end=True)
+            super().close()
+
+    class ChannelReader(io.RawIOBase):
+        def __init__(self, chunks):
+            self.chunks = chunks
+            self.pending = memoryview(b"")
+
+        def readable(self):
+            return True
+
+        def readinto(self, buf):
+            while not self.pending:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    return 0
+                self.pending = memoryview(chunk)
+            size = min(len(buf), len(self.pending))
+            buf[:size] = self.pending[:size]
+            self.pending = self.pending[size:]
+            return size
+
+        def close(self):
+            if not self.closed:
+                for _ in self.chunks: # read up to the end of the message
+                    pass
+            super().close()
+
+    def dir_handles(argv):
+        """the wire.DirHandles in argv, in the order they are sent"""
+        out = []
+        for values in argv.values():
+            for value in (values if isinstance(values, list) else [values]):
+                if isinstance(value, wire.DirHandle):
+                    out.append(value)
+        return out
+
+    def stream_handles(argv):
+        out = []
+        for values in argv.values():
+            for value in (values if isinstance(values, list) else [values]):
+                if isinstance(value, wire.StreamHandle):
+                    out.append(value)
+        return out
+
+    def pipe_handles(argv):
+        """the arguments that need to talk to the client during a call"""
+        return cli.dir_handles(argv) + cli.lazy_handles(argv) + cli.stream_handles(argv)
+
+    def lazy_handles(argv):
+        out = []
+        for values in argv.values():
+            for value in (values if isinstance(values, list) else [values]):
+                if isinstance(value, wire.FileHandle) and value.mode == "lazy":
+                    out.append(value)
+        return out
+
+    class RemoteFile(io.RawIOBase):
+        """
+            a file on the client, fetched a block at a time as it is read
+
+            the last CACHE blocks are kept, and reading through the file
+            fetches more blocks at once, doubling up to READAHEAD
+        """
+        BLOCK = 16 * 1024
+        CACHE = 64
+        READAHEAD = 32
+
+        def __init__(self, name, size, fetch):
+            self.name = name
+            self.size = size
+            self.fetch = fetch
+            self.offset = 0
+            self.blocks = OrderedDict()
+            self.next_block = None
+            self.ahead = 1
+            self.fetched = 0
+
+        def readable(self):
+            return True
+
+        def seekable(self):
+            return True
+
+        def tell(self):
+            return self.offset
+
+        def seek(self, offset, whence=io.SEEK_SET):
+            if whence == io.SEEK_CUR:
+                offset += self.offset
+            elif whence == io.SEEK_END:
+                offset += self.size
+            if offset < 0:
+                raise ValueError("negative seek position {}".format(offset))
+            self.offset = offset
+            return offset
+
+        def block(self, idx):
+            data = self.blocks.get(idx)
+            if data is not None:
+                self.blocks.move_to_end(idx)
+                return data
+            block = cli.RemoteFile.BLOCK
+            if idx == self.next_block:
+                self.ahead = min(self.ahead * 2, cli.RemoteFile.READAHEAD)
+            else:
+                self.ahead = 1
+            start = idx * block
+            count = min(self.ahead, -(-(self.size - start) // block))
+            buf = self.fetch(self.name, start, min(count * block, self.size - start))
+            self.fetched += len(buf)
+            for n in range(count):
+                self.blocks[idx + n] = buf[n*block:(n+1)*block]
+            data = self.blocks[idx]
+            while len(self.blocks) > cli.RemoteFile.CACHE:
+                self.blocks.popitem(last=False)
+            self.next_block = idx + count
+            return data
+
+        def readinto(self, buf):
+            if self.offset >= self.size:
+                return 0
+            idx, skip = divmod(self.offset, cli.RemoteFile.BLOCK)
+            data = self.block(idx)
+            size = min(len(buf), len(data) - skip, self.size - self.offset)
+            buf[:size] = data[skip:skip+size]
+            self.offset += size
+            return size
+
+    def open_lazy(handle):
+        """a lazy file: fetched from the client if remote, or opened if local"""
+        fetch = getattr(handle, '_fetch', None)
+        if fetch is None:
+            return open(handle.name, "rb")
+        return io.BufferedReader(cli.RemoteFile(handle.name, handle.size, fetch), cli.RemoteFile.BLOCK)
+
+    class StreamReader(io.RawIOBase):
+        """
+            the server's end of a stdin argument, fed chunks by the call's
+            watcher. if no input comes within IDLE seconds, idle() is called,
+            so output written so far can be sent on while it waits
+        """
+        QUEUE = 4
+        POLL = 0.1
+        IDLE = 0.01
+
+        def __init__(self, token, idle=None):
+            self.chunks = queue.Queue(cli.StreamReader.QUEUE)
+            self.token = token
+            self.idle = idle
+            self.buf = b""
+            self.eof = False
+
+        def readable(self):
+            return True
+
+        def put(self, data, stop):
+            """called by the watcher, waiting while the queue is full"""
+            while not (self.token.cancelled() or stop()):
+                try:
+                    self.chunks.put(data, timeout=cli.StreamReader.POLL)
+                    return
+                except queue.Full:
+                    pass
+
+        def readinto(self, buf):
+            wait = cli.StreamReader.IDLE if self.idle else cli.StreamReader.POLL
+            while not self.buf and not self.eof:
+                try:
+                    data = self.chunks.get(timeout=wait)
+                except queue.Empty:
+                    if wait == cli.StreamReader.IDLE:
+                        self.idle()
+                    wait = cli.StreamReader.POLL
+                    self.token.check()
+                    continue
+                self.buf = data
+                self.eof = not data
+            size = min(len(buf), len(self.buf))
+            buf[:size] = self.buf[:size]
+            self.buf = self.buf[size:]
+            return size
+
+    class StreamWriter(io.RawIOBase):
+        """the server's end of a stdout argument, sending each write as a chunk"""
+        def __init__(self, id, send, token):
+            self.id = id
+            self.send = send
+            self.token = token
+
+        def writable(self):
+            return True
+
+        def write(self, buf):
+            self.token.check()
+            try:
+                self.send(wire.Chunk(self.id, bytes(buf)))
+            except BrokenPipeError:
+                raise cli.Cancelled(self.token.reason or "client went away")
+            return len(buf)
+
+    def open_stream(handle):
+        """a stream argument: the client's, if remote, or this process's own"""
+        fh = getattr(handle, '_stream', None)
+        if fh is None:
+            return cli.open_local_stream(handle.name, handle.mode)
+        return fh
+
+    def open_local_stream(name, mode):
+        if name == "-":
+            if mode == "read":
+                return open(sys.stdin.fileno(), "rb", closefd=False)
+            sys.stdout.flush()
+            return open(sys.stdout.fileno(), "wb", closefd=False)
+        return open(name, "rb" if mode == "read" else "xb")
+
+    def walk_dir(path, include=None, exclude=None):
+        """(relative path, full path) for the files under path, filtered by globs"""
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                full = os.path.join(dirpath, filename)
+                rel = os.path.relpath(full, path).replace(os.sep, '/')
+                if include and not any(fnmatch.fnmatchcase(rel, g) for g in include):
+                    continue
+                if exclude and any(fnmatch.fnmatchcase(rel, g) for g in exclude):
+                    continue
+                yield rel, full
+
+    def pack_dir(path, fileobj, include=None, exclude=None):
+        with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+            if path is not None:
+                for rel, full in cli.walk_dir(path, include, exclude):
+                    tar.add(full, arcname=rel, recursive=False)
+
+    def unpack_dir(fileobj, path):
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+            for member in tar:
+                name = os.path.normpath(member.name)
+                if os.path.isabs(name) or name.split(os.sep)[0] == '..':
+                    continue
+                if not (member.isfile() or member.isdir()):
+                    continue
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extract(member, path, filter='data')
+                else:
+                    tar.extract(member, path)
+
+    def copy_dir(src, dest, include=None, exclude=None):
+        for rel, full in cli.walk_dir(src, include, exclude):
+            target = os.path.join(dest, *rel.split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(full, target)
+
+    class Scheduler:
+        """
+            bounds how many calls a server runs at once
+
+            calls past the limit wait their turn, and once the queue is full,
+            calls are turned away with a busy response. renders and status
+            requests skip the queue, so completion and help stay quick while
+            long calls run
+        """
+        CALLS = 16
+        QUEUE = 256
+        POLL = 0.1
+
+        def __init__(self, calls=CALLS, queue=QUEUE):
+            self.calls = calls
+            self.queue = queue
+            self.cond = threading.Condition()
+            self.running = 0
+            self.waiting = 0
+            self.peak_waiting = 0
+            self.admitted = 0
+            self.rejected = 0
+            self.wait_time = 0.0
+
+        def admit(self):
+            """take a place in the queue, or False if it is full"""
+            with self.cond:
+                if self.running >= self.calls and self.waiting >= self.queue:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+                self.peak_waiting = max(self.peak_waiting, self.waiting)
+                return True
+
+        def start(self, token):
+            """wait for a free slot, raising cli.Cancelled if the call is cancelled first"""
+            start = time.monotonic()
+            with self.cond:
+                try:
+                    while self.running >= self.calls:
+                        token.check()
+                        self.cond.wait(cli.Scheduler.POLL)
+                finally:
+                    self.waiting -= 1
+                self.running += 1
+                self.admitted += 1
+                self.wait_time += time.monotonic() - start
+
+        def finish(self):
+            with self.cond:
+                self.running -= 1
+                self.cond.notify()
+
+        def stats(self):
+            with self.cond:
+                return {
+                    'calls': self.calls,
+                    'queue': self.queue,
+                    'running': self.running,
+                    'waiting': self.waiting,
+                    'peak_waiting': self.peak_waiting,
+                    'admitted': self.admitted,
+                    'rejected': self.rejected,
+                    'mean_wait': self.wait_time / self.admitted if self.admitted else 0.0,
+                }
+
+    def offer_pipe(root, recorder=None, scheduler=None):
         #print('offering', file=sys.stderr)
-        while not sys.stdin.buffer.closed and not sys.stdout.buffer.closed:
-            line = sys.stdin.buffer.readline()
-            if not line: break
-            size = int(line.decode('ascii').strip())
-            buf = sys.stdin.buffer.read(size)
-            obj, _ = codec.parse(buf, 0)
+        channel = cli.Channel(sys.stdin.buffer, sys.stdout.buffer, server=True)
+        tree = root.render()
+        tree.digest()
+        scheduler = scheduler or cli.Scheduler()
+        handlers = []
+        while True:
+            stream = channel.accept()
+            if stream is None: break
+            handler = threading.Thread(target=cli.serve_stream, args=(root, tree, channel, stream, recorder, scheduler), daemon=True)
+            handler.start()
+            handlers.append(handler)
+            handlers = [h for h in handlers if h.is_alive()]
+        for handler in handlers:
+            handler.join()
+        return 0
 
-            if obj.action == "render":
-                response = root.render()
-            elif obj.action == "call":
-                response = root.call(obj.path, obj.argv)
+    def serve_stream(root, tree, channel, stream, recorder=None, scheduler=None):
+        """
+            a call is followed by a tar stream for each indir, and its
+            response by a tar stream for each outdir. the directories are
+            kept in temporary directories for the duration of the call
 
-            buf = codec.dump(response, bytearray())
+            renders are answered from the tree rendered at startup, and
+            status with the scheduler's stats, without waiting for calls
+        """
+        handles = []
+        try:
+            obj = channel.recv_obj(stream)
+            start = time.monotonic()
 
-            sys.stdout.buffer.write(b"%d\n" % (len(buf)))
-            sys.stdout.buffer.write(buf)
-            sys.stdout.buffer.flush()
+            if obj.action == "render":
+                channel.send_obj(stream, tree)
+                if recorder:
+                    recorder.record(obj, start, time.monotonic() - start)
+            elif obj.action == "status":
+                channel.send_obj(stream, scheduler.stats() if scheduler else {})
+            elif obj.action == "call":
+                handles = cli.dir_handles(obj.argv)
+                for handle in handles:
+                    handle.path = tempfile.mkdtemp(prefix="textfree86-")
+                    if handle.mode == "read":
+                        with channel.reader(stream) as fh:
+                            cli.unpack_dir(fh, handle.path)
+
+                if obj.digest and obj.digest != tree.digest():
+                    channel.send_obj(stream, wire.Stale(tree))
+                    return
+
+                if scheduler and not scheduler.admit():
+                    response = wire.Response(-1, "busy: too many calls waiting")
+                    channel.send_obj(stream, response)
+                else:
+                    response = cli.serve_call(root, channel, stream, obj, scheduler)
+                if recorder:
+                    recorder.record(obj, start, time.monotonic() - start)
+                for handle in handles:
+                    if handle.mode == "write":
+                        path = handle.path if response.exit_code == 0 else None
+                        with channel.writer(stream) as fh:
+                            cli.pack_dir(path, fh, handle.include, handle.exclude)
+            # otherwise, a cancel for a request that already finished
+        except (EOFError, BrokenPipeError):
+            pass
+        except Exception:
+            traceback.print_exc()
+            channel.reset(stream)
+        finally:
+            channel.close(stream)
+            for handle in handles:
+                shutil.rmtree(handle.path, ignore_errors=True)
+
+    def serve_call(root, channel, stream, obj, scheduler=None):
+        """
+            runs the call on a worker thread, while watching the stream for
+            a cancel message, and gives up on the worker once the deadline
+            passes. an abandoned worker keeps running until it notices its
+            cancelled token, or returns
+
+            lazy files send a wire.Fetch down the stream, and the watcher
+            hands them the bytes the client sends back
+
+            with a scheduler, the call has been admitted, and the worker
+            waits for a free slot before running it
+
+            streams send wire.Chunks down the stream as they are written, and
+            the watcher queues up the chunks the client sends for them
+
+            the response is sent down the stream under the same lock as the
+            worker's chunks and fetches, so it waits for a message that is
+            half sent, and nothing the worker sends can follow it
+
+            without a channel, as over http, only the deadline can cancel
+            the call, lazy files can't be fetched, and the response is
+            returned for the caller to send
+        """
+        token = cli.CancelToken(obj.timeout)
+        events = queue.Queue()
+        replies = queue.Queue()
+        fetch_lock = threading.Lock()
+        send_lock = threading.Lock()
+        done = threading.Event()
+        sent = threading.Event()
+
+        def send(obj, final=False):
+            with send_lock:
+                if sent.is_set():
+                    raise cli.Cancelled(token.reason or "call already answered")
+                if not final:
+                    token.check()
+                else:
+                    sent.set()
+                channel.send_obj(stream, obj)
+
+        def fetch(name, offset, size):
+            with fetch_lock:
+                if token.cancelled():
+                    raise cli.Cancelled(token.reason)
+                send(wire.Fetch(name, offset, size))
+                reply = replies.get()
+            if reply is None:
+                raise cli.Cancelled(token.reason or "client went away")
+            return reply
+
+        for handle in cli.lazy_handles(obj.argv):
+            handle._fetch = fetch
+
+        readers, writers = {}, []
+        def flush_writers():
+            for writer in writers:
+                writer.flush()
+
+        for handle in cli.stream_handles(obj.argv):
+            if handle.mode == "read":
+                readers[handle.id] = cli.StreamReader(token, flush_writers)
+                handle._stream = io.BufferedReader(readers[handle.id], cli.Channel.CHUNK)
+            else:
+                handle._stream = io.BufferedWriter(cli.StreamWriter(handle.id, send, token), cli.Channel.CHUNK)
+                writers.append(handle._stream)
+
+        def work():
+            try:
+                if scheduler:
+                    scheduler.start(token)
+            except cli.Cancelled as e:
+                events.put(wire.Response(-1, "cancelled: {}".format(e)))
+                return
+            try:
+                if obj.profile:
+                    profiler = cProfile.Profile()
+                    response = profiler.runcall(root.call, obj.path, obj.argv, token)
+                    profiler.create_stats()
+                    if isinstance(response, wire.Response):
+                        stats = marshal.dumps(profiler.stats)
+                        response = wire.Response(response.exit_code, response.value, response.file_handles, stats)
+                    events.put(response)
+                else:
+                    events.put(root.call(obj.path, obj.argv, token))
+            except cli.Cancelled as e:
+                events.put(wire.Response(-1, "cancelled: {}".format(e)))
+            except Exception as e:
+                traceback.print_exc()
+                events.put(wire.Response(-1, "error: {!r}".format(e)))
+            finally:
+                if scheduler:
+                    scheduler.finish()
+
+        def watch():
+            try:
+                while True:
+                    msg = channel.recv_obj(stream)
+                    if isinstance(msg, wire.Request) and msg.action == "cancel":
+                        break
+                    if isinstance(msg, wire.Chunk):
+                        if msg.id in readers:
+                            readers[msg.id].put(msg.data, lambda: done.is_set() or channel.is_closed(stream))
+                        continue
+                    replies.put(msg)
+                events.put("cancelled by client")
+            except EOFError:
+                events.put("client went away")
+            replies.put(None)
+
+        threading.Thread(target=work, daemon=True).start()
+        if channel is not None:
+            threading.Thread(target=watch, daemon=True).start()
+        try:
+            event = events.get(timeout=token.remaining())
+        except queue.Empty:
+            event = "deadline exceeded"
+        finally:
+            done.set()
+
+        if isinstance(event, str):
+            token.cancel(event)
+            event = wire.Response(-1, "cancelled: {}".format(token.reason))
+        if channel is not None:
+            send(event, final=True)
+        return event
+
+
+    def offer_http(root, address, recorder=None, scheduler=None):
+        host, _, port = address.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host, int(port)), cli.HTTPHandler)
+        server.daemon_threads = True
+        server.root = root
+        server.tree = root.render()
+        server.tree.digest()
+        server.recorder = recorder
+        server.scheduler = scheduler or cli.Scheduler()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
         return 0
 
+    class HTTPHandler(http.server.BaseHTTPRequestHandler):
+        """
+            GET /tree, or /tree/<subcommand>/..., answers with the rendered
+            tree, and its digest as the ETag, so any http cache can keep it
+
+            POST /call takes an encoded wire.Request, and sends back the
+            response chunked, as "<size>\n" prefixed parts: the names the
+            message interns, the message, and then each of its streamed
+            bytes, written out from the value itself rather than copied into
+            the message. GET /status has the scheduler's stats
+
+            connections are kept open between requests
+        """
+        protocol_version = "HTTP/1.1"
+        CONTENT_TYPE = "application/x-textfree86"
+
+        def do_GET(self):
+            path = [p for p in urllib.parse.urlsplit(self.path).path.split('/') if p]
+            if path == ["status"]:
+                return self.send_obj(self.server.scheduler.stats())
+            if not path or path[0] != "tree":
+                return self.send_error(404)
+            tree = self.server.tree
+            for name in path[1:]:
+                name = urllib.parse.unquote(name)
+                if name not in tree.subcommands:
+                    return self.send_error(404)
+                tree = tree.subcommands[name]
+
+            etag = '"{}"'.format(tree.digest())
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            matches = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+            if etag in matches or '*' in matches:
+                self.send_response(304)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                return
+            start = time.monotonic()
+            self.send_obj(tree, headers)
+            if self.server.recorder and not path[1:]:
+                self.server.recorder.record(wire.Request("render", None, None), start, time.monotonic() - start)
+
+        def do_POST(self):
+            if urllib.parse.urlsplit(self.path).path != "/call":
+                return self.send_error(404)
+            length = self.headers.get('Content-Length')
+            if length is None:
+                return self.send_error(411)
+            try:
+                obj, _ = codec.parse(self.rfile.read(int(length)), 0)
+            except (ValueError, KeyError, IndexError):
+                return self.send_error(400)
+            if not isinstance(obj, wire.Request) or obj.action != "call":
+                return self.send_error(400)
+
+            server, start = self.server, time.monotonic()
+            if cli.pipe_handles(obj.argv):
+                response = wire.Response(-1, "error: directories, lazy files and streams need a pipe")
+            elif obj.digest and obj.digest != server.tree.digest():
+                response = wire.Stale(server.tree)
+            elif not server.scheduler.admit():
+                response = wire.Response(-1, "busy: too many calls waiting")
+            else:
+                response = cli.serve_call(server.root, None, None, obj, server.scheduler)
+                if server.recorder:
+                    server.recorder.record(obj, start, time.monotonic() - start)
+            self.send_parts(response)
+
+        def send_parts(self, obj):
+            table = codec.Table()
+            table.streamed = []
+            buf = codec.dump(obj, bytearray(), table)
+            names = codec.dump(table.flush(), bytearray())
+            self.send_response(200)
+            self.send_header('Content-Type', cli.HTTPHandler.CONTENT_TYPE)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for part in [names, buf] + table.streamed:
+                self.send_chunk(b"%d\n" % len(part))
+                view = memoryview(part)
+                for offset in range(0, len(view), cli.Channel.CHUNK):
+                    self.send_chunk(view[offset:offset+cli.Channel.CHUNK])
+            self.wfile.write(b"0\r\n\r\n")
+
+        def send_chunk(self, data):
+            self.wfile.write(b"%x\r\n" % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b"\r\n")
+
+        def send_obj(self, obj, headers=()):
+            buf = codec.dump(obj, bytearray())
+            self.send_response(200)
+            self.send_header('Content-Type', cli.HTTPHandler.CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(buf)))
+            for key, value in dict(headers).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(buf)
 
     class PipeClient:
-        def __init__(self, request, response):
-            self.request = request 
-            self.response = response
+        """
+            with a timeout, calls carry a deadline to the server, and the
+            client gives up GRACE seconds after it. interrupting a request
+            sends a cancel for it
+
+            with a cache file, the command tree is loaded from disk instead
+            of asking the server, so completion and help need no round trip,
+            and a call needs only one. calls carry the digest of the cached
+            tree, and the server answers wire.Stale if it has changed
+
+            with profile set, calls are run under cProfile on the server,
+            and the stats are saved to that file, or printed if it is ''
+
+            given a cmd instead of a pair of pipes, the command is started
+            on the first request, so completion and help from a cached tree
+            don't start it at all
+        """
+        GRACE = 5.0
+
+        def __init__(self, request=None, response=None, timeout=None, cache=None, shared=True, recorder=None, profile=None, cmd=None):
+            self.channel = None
+            if request is not None:
+                self.channel = cli.Channel(response, request, shared=shared)
+            self.cmd = cmd
+            self.shared = shared
+            self.process = None
+            self.recorder = recorder
+            self.warm = False
+            self.profile = profile
+            self.timeout = timeout
+            self.cache = cache
+            self.tree = None
+            self.fresh = False
+
+        def request(self, obj, timeout=None, record=True):
+            if self.recorder and record and not self.warm:
+                # so the first recorded request doesn't include starting the server
+                self.warm = True
+                self.request(wire.Request("status", None, None), record=False)
+            self.connect()
+            handles = cli.dir_handles(obj.argv) if obj.action == "call" else ()
+            streams = cli.stream_handles(obj.argv) if obj.action == "call" else ()
+            lazy = cli.lazy_handles(obj.argv) if obj.action == "call" else ()
+            sizes = {handle.name: handle.size for handle in lazy}
+            inputs, outputs = {}, {}
+            for idx, handle in enumerate(streams):
+                handle.id = idx
+                fh = cli.open_local_stream(handle.name, handle.mode)
+                (inputs if handle.mode == "read" else outputs)[idx] = fh
+
+            stream = self.channel.open()
+            send_lock = threading.Lock()
+            def send(obj):
+                with send_lock:
+                    self.channel.send_obj(stream, obj)
+
+            try:
+                self.channel.send_obj(stream, obj)
+                for handle in handles:
+                    if handle.mode == "read":
+                        with self.channel.writer(stream) as fh:
+                            cli.pack_dir(handle.name, fh, handle.include, handle.exclude)
+                for idx, fh in inputs.items():
+                    threading.Thread(target=cli.send_stream, args=(idx, fh, send), daemon=True).start()
+                start = time.monotonic()
+                files = {}
+                try:
+                    response = self.channel.recv_obj(stream, timeout)
+                    while isinstance(response, (wire.Fetch, wire.Chunk)):
+                        if isinstance(response, wire.Fetch):
+                            data = cli.read_range(files, sizes, response)
+                            if data is None:
+                                self.channel.reset(stream)
+                                return wire.Response(-1, "error: server asked for a file outside the call's lazy files")
+                            send(data)
+                        else:
+                            outputs[response.id].write(response.data)
+                            outputs[response.id].flush()
+                        response = self.channel.recv_obj(stream, timeout)
+                except (KeyboardInterrupt, TimeoutError, BrokenPipeError):
+                    if streams:
+                        # the stream may be out of credit, so skip the queue
+                        self.channel.reset(stream)
+                    else:
+                        send(wire.Request("cancel", None, None))
+                    raise
+                finally:
+                    for fh in files.values():
+                        fh.close()
+                    for fh in outputs.values():
+                        fh.close()
+                if self.recorder and record:
+                    self.recorder.record(obj, start, time.monotonic() - start)
+                if isinstance(response, wire.Response):
+                    for handle in handles:
+                        if handle.mode == "write":
+                            with self.channel.reader(stream) as fh:
+                                cli.unpack_dir(fh, handle.name)
+                return response
+            finally:
+                self.channel.close(stream)
+
+        def connect(self):
+            if self.channel is None:
+                self.process = subprocess.Popen(
+                    self.cmd,
+                    shell = True,
+                    stdin = subprocess.PIPE,
+                    stdout = subprocess.PIPE,
+                )
+                self.channel = cli.Channel(self.process.stdout, self.process.stdin, shared=self.shared)
+            return self.channel
+
+        def close(self):
+            if self.process is not None:
+                self.process.stdin.close()
+                self.process.wait()
+
+        def load(self):
+            try:
+                with open(self.cache, "rb") as fh:
+                    obj, _ = codec.parse(fh.read(), 0)
+            except (OSError, ValueError, KeyError, IndexError):
+                return None
+            if not isinstance(obj, wire.Command):
+                return None
+            if obj.index is None:
+                # written before the index was part of the tree
+                todo = [obj]
+                while todo:
+                    command = todo.pop()
+                    command.build_index()
+                    todo.extend(command.subcommands.values())
+            return obj
+
+        def status(self):
+            return self.request(wire.Request("status", None, None))
+
+        def refresh(self, tree=None):
+            if tree is None:
+                tree = self.request(wire.Request("render", None, None))
+            self.tree, self.fresh = tree, True
+            if not self.cache:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.cache), exist_ok=True)
+                tmp = "{}.{}".format(self.cache, os.getpid())
+                with open(tmp, "wb") as fh:
+                    fh.write(codec.dump(tree, bytearray()))
+                os.replace(tmp, self.cache)
+            except OSError:
+                pass
 
         def render(self):
-            obj = wire.Request("render", None, None)
-            buf = codec.dump(obj, bytearray())
-            self.request.write(b"%d\n"%(len(buf)))
-            self.request.write(buf)
-            self.request.flush()
-            size = int(self.response.readline().strip())
-            buf = self.response.read(size)
-            obj, _ = codec.parse(buf, 0)
-            return obj
+            if self.tree is None and self.cache:
+                self.tree = self.load()
+            if self.tree is None:
+                self.refresh()
+            return self.tree
 
         def call(self, path, argv):
-            obj = wire.Request("call", path, argv)
-            buf = codec.dump(obj, bytearray())
-            self.request.write(b"%d\n"%(len(buf)))
-            self.request.write(buf)
-            self.request.flush()
-            size = int(self.response.readline().strip())
-            buf = self.response.read(size)
-            obj, _ = codec.parse(buf, 0)
+            digest = None if self.fresh else self.tree and self.tree.digest()
+            obj = wire.Request("call", path, argv, timeout=self.timeout, digest=digest, profile=self.profile is not None)
+            try:
+                response = self.request(obj, None if self.timeout is None else self.timeout + cli.PipeClient.GRACE)
+            except TimeoutError:
+                return wire.Response(-1, "cancelled: deadline exceeded")
+            if isinstance(response, wire.Response) and response.profile:
+                cli.show_profile(response.profile, self.profile)
+            return response
+
+    def show_profile(data, path):
+        """save marshalled stats as a pstats file, or print the top of them to stderr"""
+        if path:
+            with open(path, "wb") as fh:
+                fh.write(data)
+            return
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write(data)
+            fh.flush()
+            stats = pstats.Stats(fh.name, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(cli.PROFILE_LINES)
+
+    PROFILE_LINES = 25
+
+    class HTTPClient(PipeClient):
+        """
+            talks to a server started with --http=<host>:<port>, over one
+            kept-alive connection
+
+            the cached tree is checked with If-None-Match, so an unchanged
+            tree is a 304 with no body. interrupting a call drops the
+            connection, but the server carries on until the call's deadline
+        """
+
+        def __init__(self, url, timeout=None, cache=None, recorder=None, profile=None):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme == "https":
+                self.conn = http.client.HTTPSConnection(parts.netloc)
+            else:
+                self.conn = http.client.HTTPConnection(parts.netloc)
+            self.base = parts.path.rstrip('/')
+            self.recorder = recorder
+            self.profile = profile
+            self.timeout = timeout
+            self.cache = cache
+            self.tree = None
+            self.fresh = False
+
+        def close(self):
+            self.conn.close()
+
+        def fetch(self, method, path, body=None, headers=None, timeout=None, read=None):
+            """
+                send a request, retrying a GET once if the kept-alive
+                connection was closed. the body is read with read(response),
+                if given, or whole
+            """
+            headers = dict(headers or {})
+            if body is not None:
+                headers['Content-Type'] = cli.HTTPHandler.CONTENT_TYPE
+            for retry in (method == "GET", False):
+                self.conn.timeout = timeout
+                if self.conn.sock is not None:
+                    self.conn.sock.settimeout(timeout)
+                try:
+                    self.conn.request(method, self.base + path, body, headers)
+                    response = self.conn.getresponse()
+                    if read is not None and response.status == 200:
+                        return response, read(response)
+                    return response, response.read()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    self.conn.close()
+                    if not retry:
+                        raise
+                except BaseException:
+                    self.conn.close()
+                    raise
+
+        def request(self, obj, timeout=None, record=True):
+            start = time.monotonic()
+            if obj.action == "render":
+                headers = {}
+                if self.tree is not None:
+                    headers['If-None-Match'] = '"{}"'.format(self.tree.digest())
+                response, buf = self.fetch("GET", "/tree", headers=headers, timeout=timeout)
+            elif obj.action == "status":
+                response, buf = self.fetch("GET", "/status", timeout=timeout)
+            else:
+                response, buf = self.fetch("POST", "/call", codec.dump(obj, bytearray()), timeout=timeout, read=cli.HTTPClient.read_parts)
+
+            if response.status == 304:
+                result = self.tree
+            elif response.status == 200 and obj.action == "call":
+                result = buf
+            elif response.status == 200:
+                result, _ = codec.parse(buf, 0)
+            else:
+                raise Exception("http error {} {}".format(response.status, response.reason))
+            if self.recorder and record:
+                self.recorder.record(obj, start, time.monotonic() - start)
+            return result
+
+        def read_parts(response):
+            """the reply to a call, see cli.HTTPHandler, filling in its streamed bytes as they arrive"""
+            def part():
+                line = response.readline()
+                if not line.endswith(b"\n"):
+                    raise EOFError("response ended early")
+                return int(line)
+
+            table = codec.Table()
+            names, _ = codec.parse(response.read(part()), 0)
+            table.define(names)
+            table = table.message()
+            obj, _ = codec.parse(response.read(part()), 0, table)
+            for out in table.streamed:
+                if part() != len(out):
+                    raise ValueError("streamed bytes of the wrong size")
+                view, offset = memoryview(out), 0
+                while offset < len(out):
+                    size = response.readinto(view[offset:offset+cli.Channel.CHUNK])
+                    if not size:
+                        raise EOFError("response ended early")
+                    offset += size
+            response.read()
             return obj
 
+    def cache_path(cmd):
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        name = hashlib.sha256(cmd.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(cache_dir, 'textfree86', name)
+
+    class Recorder:
+        """
+            appends each request to a file, for cli.replay
+
+            each entry is "<size>\n" and a codec record of start (seconds
+            since recording began), elapsed (seconds taken to reply), and
+            the request itself, including any input files. calls with
+            directories, lazy files or streams are not recorded, as their
+            contents are not part of the request
+        """
+        def __init__(self, path):
+            self.fh = open(path, "ab")
+            self.lock = threading.Lock()
+            self.started = time.monotonic()
+
+        def record(self, request, start, elapsed):
+            if request.action == "call" and cli.pipe_handles(request.argv):
+                return
+            entry = {'start': start - self.started, 'elapsed': elapsed, 'request': request}
+            buf = codec.dump(entry, bytearray())
+            with self.lock:
+                self.fh.write(b"%d\n" % (len(buf)))
+                self.fh.write(buf)
+                self.fh.flush()
+
+        def read(path):
+            with open(path, "rb") as fh:
+                while True:
+                    line = fh.readline()
+                    if not line: break
+                    entry, _ = codec.parse(fh.read(int(line)), 0)
+                    yield entry
+
+    def percentiles(values):
+        values = sorted(values)
+        if not values:
+            return "n/a"
+        out = []
+        for p in (50, 90, 99):
+            out.append("p{} {:.1f}ms".format(p, 1000 * values[min(len(values)-1, len(values)*p//100)]))
+        out.append("max {:.1f}ms".format(1000 * values[-1]))
+        return " ".join(out)
+
+    def replay(cmd, path, concurrency=1, rate=None):
+        """
+            sends recorded requests to fresh copies of cmd, one per unit of
+            concurrency, at rate requests per second (or as fast as they
+            go), and reports the throughput and latency
+        """
+        jobs = queue.Queue()
+        skipped = 0
+        recorded = []
+        for entry in cli.Recorder.read(path):
+            obj = entry['request']
+            if obj.action == "call" and cli.pipe_handles(obj.argv):
+                skipped += 1
+                continue
+            obj.digest = None
+            jobs.put(obj)
+            recorded.append(entry['elapsed'])
+        total = jobs.qsize()
+
+        procs, clients = [], []
+        for _ in range(concurrency):
+            p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            procs.append(p)
+            clients.append(cli.PipeClient(p.stdin, p.stdout))
+        for client in clients: # wait for each copy to start
+            client.render()
+
+        results = []
+        lock = threading.Lock()
+        sent = itertools.count()
+        start = time.monotonic()
+
+        def work(client):
+            while True:
+                try:
+                    obj = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                if rate:
+                    delay = start + next(sent) / rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                begin = time.monotonic()
+                try:
+                    response = client.request(obj)
+                    ok = getattr(response, 'exit_code', 0) == 0
+                except Exception:
+                    ok = False
+                with lock:
+                    results.append((time.monotonic() - begin, ok))
+
+        workers = [threading.Thread(target=work, args=(c,)) for c in clients]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - start
+
+        for p in procs:
+            p.stdin.close()
+            p.wait()
+
+        errors = len([ok for _, ok in results if not ok])
+        print("requests: {} ({} errors, {} skipped)".format(total, errors, skipped))
+        print("elapsed: {:.3f}s".format(elapsed))
+        print("throughput: {:.1f} req/s".format(total / elapsed if elapsed else 0))
+        print("latency: {}".format(cli.percentiles([t for t, _ in results])))
+        print("recorded: {}".format(cli.percentiles(recorded)))
+        return 1 if errors else 0
+
+    IO_WORKERS = 8
+
+    def send_stream(id, fh, send):
+        """copy a local file or stdin to the server as it is read, until it ends or the call does"""
+        try:
+            with fh:
+                while True:
+                    data = fh.read1(cli.Channel.CHUNK)
+                    send(wire.Chunk(id, data))
+                    if not data:
+                        break
+        except (OSError, KeyError, ValueError):
+            pass
+
+    def read_range(files, sizes, fetch):
+        """
+            the bytes a wire.Fetch asks for, or None unless they lie within
+            one of the lazy files of the call, given as a map of name to size
+        """
+        name, offset, size = fetch.name, fetch.offset, fetch.size
+        if not isinstance(name, str) or name not in sizes:
+            return None
+        if not isinstance(offset, int) or not isinstance(size, int):
+            return None
+        if offset < 0 or size < 0 or offset + size > sizes[name]:
+            return None
+        if fetch.name not in files:
+            files[fetch.name] = open(fetch.name, "rb")
+        fh = files[fetch.name]
+        fh.seek(fetch.offset)
+        return fh.read(fetch.size)
+
+    def read_file(name):
+        with open(name, "rb") as fh:
+            return fh.read()
+
+    def write_file(fh, buf):
+        with fh:
+            fh.write(buf)
+
     def run(root, argv, environ):
+        """
+            input files are read, and output files written, on a pool of
+            IO_WORKERS threads, so slow filesystems aren't visited one by one
+
+            if the call was made against a stale cached tree, the server
+            replies with the current one, and the command line is parsed again.
+            the same happens if a cached tree can't parse the command line
+        """
+        raw_argv = list(argv)
         obj = root.render()
 
         if 'COMP_LINE' in environ and 'COMP_POINT' in environ:
@@ -944,6 +2931,10 @@ class cli:
             action = cli.Action("help", [], {'usage': True})
         else:
             action = obj.parse_args([], argv, environ)
+
+        if action.mode == "error" and not root.fresh:
+            root.refresh()
+            return cli.run(root, raw_argv, environ)
     
         if action.mode == "complete":
             result = obj.complete(action.path, action.argv)
@@ -953,51 +2944,84 @@ class cli:
         elif action.mode == "call":
             file_handles = {}
             argv = {}
-            for name, values in action.argv.items():
-                if isinstance(values, list):
-                    out = []
-                    for value in values:
-                        if isinstance(value, wire.FileHandle):
-                            if value.mode == "read":
-                                with open(value.name, "rb") as fh:
-                                    buf = fh.read()
-                                out.append(wire.FileHandle(value.name, "read", buf=buf))
+            reads = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=cli.IO_WORKERS) as pool:
+                def infile(value):
+                    if value.mode == "lazy":
+                        return wire.FileHandle(value.name, "lazy", size=os.path.getsize(value.name))
+                    out = wire.FileHandle(value.name, "read")
+                    reads.append((out, pool.submit(cli.read_file, value.name)))
+                    return out
+
+                dirs = []
+                def outdir(value):
+                    if value.mode == "write":
+                        os.makedirs(value.name)
+                        dirs.append(value.name)
+                    elif not os.path.isdir(value.name):
+                        raise NotADirectoryError(value.name)
+                    return value
+
+                for name, values in action.argv.items():
+                    if isinstance(values, list):
+                        out = []
+                        for value in values:
+                            if isinstance(value, wire.DirHandle):
+                                out.append(outdir(value))
+                            elif isinstance(value, wire.FileHandle):
+                                if value.mode in ("read", "lazy"):
+                                    out.append(infile(value))
+                                elif value.mode == "write":
+                                    fh = open(value.name, "xb")
+                                    if name not in file_handles:
+                                        file_handles[name] = []
+                                    file_handles[name].append(fh)
+                                    out.append(value)
+                            else:
+                                out.append(value)
+                        argv[name] = out
+                    else:
+                        value = values
+                        if isinstance(value, wire.DirHandle):
+                            argv[name] = outdir(value)
+                        elif isinstance(value, wire.FileHandle):
+                            if value.mode in ("read", "lazy"):
+                                argv[name] = infile(value)
                             elif value.mode == "write":
                                 fh = open(value.name, "xb")
                                 if name not in file_handles:
                                     file_handles[name] = []
                                 file_handles[name].append(fh)
-                                out.append(value)
+                                argv[name] = value
                         else:
-                            out.append(value)
-                    argv[name] = out
-                else:
-                    value = values
-                    if isinstance(value, wire.FileHandle):
-                        if value.mode == "read":
-                            with open(value.name, "rb") as fh:
-                                buf = fh.read()
-                            argv[name] = wire.FileHandle(value.name, "read", buf=buf)
-                        elif value.mode == "write":
-                            fh = open(value.name, "xb")
-                            if name not in file_handles:
-                                file_handles[name] = []
-                            file_handles[name].append(fh)
                             argv[name] = value
-                    else:
-                        argv[name] = value
-
-            result =  root.call(action.path, argv)
 
-            if file_handles and isinstance(result, wire.Response) and result.file_handles:
-                for name, fhs in file_handles.items():
-                    for idx, fh in enumerate(fhs):
-                        fh.write(result.file_handles[name][idx])
-                        fh.close()
-            elif file_handles:
-                for name, fhs in file_handles.items():
-                    for fh in fhs:
-                        fh.close()
+                for fh, future in reads:
+                    fh.buf = future.result()
+
+                result =  root.call(action.path, argv)
+
+                if isinstance(result, wire.Stale):
+                    for fhs in file_handles.values():
+                        for fh in fhs:
+                            fh.close()
+                            os.unlink(fh.name)
+                    for name in dirs:
+                        os.rmdir(name)
+                    root.refresh(result.command)
+                    return cli.run(root, raw_argv, environ)
+
+                writes = []
+                if file_handles and isinstance(result, wire.Response) and result.file_handles:
+                    for name, fhs in file_handles.items():
+                        for idx, fh in enumerate(fhs):
+                            writes.append(pool.submit(cli.write_file, fh, result.file_handles[name][idx]))
+                elif file_handles:
+                    for name, fhs in file_handles.items():
+                        for fh in fhs:
+                            fh.close()
+                for future in writes:
+                    future.result()
 
         elif action.mode == "version":
             result = obj.version()